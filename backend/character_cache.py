@@ -0,0 +1,36 @@
+from cachetools import LRUCache, TTLCache
+from typing import Dict, Any, Optional
+
+class CharacterCache:
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        # Maps Character ID to shaped character; expires after `ttl` and
+        # evicts least-recently-used entries past `maxsize`
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Maps Character ID to a version token, replaced on every invalidate so a
+        # read that raced a write can't cache stale data. Bounded too: losing a
+        # token only means that read's result isn't cached.
+        self._versions: LRUCache = LRUCache(maxsize=maxsize)
+
+    def get(self, char_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached character, or None if it's missing or expired.
+        Callers must treat the result as read-only - it's shared.
+        """
+        return self._entries.get(char_id)
+
+    def version(self, char_id: str) -> object:
+        token = self._versions.get(char_id)
+        if token is None:
+            token = self._versions[char_id] = object()
+        return token
+
+    def set(self, char_id: str, data: Dict[str, Any], version: object):
+        """Cache `data`, unless the character was invalidated since `version` was taken."""
+        if self._versions.get(char_id) is version:
+            self._entries[char_id] = data
+
+    def invalidate(self, char_id: str):
+        # The next version() hands out a fresh token, so older ones no longer match
+        self._versions.pop(char_id, None)
+        self._entries.pop(char_id, None)
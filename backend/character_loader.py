@@ -0,0 +1,58 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+class CharacterLoader:
+    """
+    Coalesces character reads. Every load() issued within `window` seconds of
+    the first one is served by a single fetch_many() call (e.g. BatchGetItem),
+    and concurrent loads of the same character share one result. A window of
+    0 batches whatever was requested in the current event loop tick.
+    """
+    def __init__(self, fetch_many: Callable[[List[str]], Awaitable[Dict[str, Any]]],
+                 window: float, max_batch: int):
+        self.fetch_many = fetch_many
+        self.window = window
+        self.max_batch = max_batch
+        # Maps Character ID to the future every caller waiting on it shares
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.Handle] = None
+        # Keep in-flight batches referenced so they aren't garbage collected
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, char_id: str) -> Optional[Dict[str, Any]]:
+        future = self._pending.get(char_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[char_id] = future
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._timer is None:
+                if self.window > 0:
+                    self._timer = loop.call_later(self.window, self._dispatch)
+                else:
+                    self._timer = loop.call_soon(self._dispatch)
+        # Shielded so one caller giving up doesn't cancel the read for the others
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.create_task(self._resolve(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, batch: Dict[str, asyncio.Future]):
+        try:
+            results = await self.fetch_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for char_id, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(char_id))
@@ -0,0 +1,18 @@
+import asyncio
+from weakref import WeakValueDictionary
+
+class CharacterLocker:
+    def __init__(self):
+        # Maps Character ID to the lock serializing its read-modify-write paths.
+        # Weak, so a lock goes away once nobody holds or waits on it.
+        self._locks: WeakValueDictionary = WeakValueDictionary()
+
+    def lock(self, character_id: str) -> asyncio.Lock:
+        """
+        Serialize fetch-modify-write sequences on one character within this
+        worker, so they don't keep failing each other's conditional writes.
+        """
+        lock = self._locks.get(character_id)
+        if lock is None:
+            lock = self._locks[character_id] = asyncio.Lock()
+        return lock
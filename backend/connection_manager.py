@@ -1,36 +1,149 @@
 from fastapi import WebSocket
-from typing import List, Dict
+from typing import List, Dict, Set
+from collections import defaultdict
+import asyncio
+import zlib
+
+from serialization import dumps
+
+# Frames a client may fall behind by before we give up on it
+SEND_QUEUE_SIZE = 256
+
+# Payloads at least this big are deflated once and the result shared by every
+# viewer. Run the server without per-message-deflate (uvicorn
+# --ws-per-message-deflate false) so they aren't compressed again per socket.
+COMPRESS_THRESHOLD = 512
+# First byte of a deflated frame; plain frames are JSON and start with { or [
+COMPRESSED_FRAME = b"\x01"
+
+def _encode(message: dict) -> bytes:
+    payload = dumps(message)
+    if len(payload) < COMPRESS_THRESHOLD:
+        return payload
+    # Raw deflate (no zlib header), inflated by DecompressionStream('deflate-raw')
+    deflater = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return COMPRESSED_FRAME + deflater.compress(payload) + deflater.flush()
+
+def _frames(batch: List[bytes]):
+    """
+    Join runs of plain JSON payloads into single array frames. Compressed
+    payloads can't be spliced into an array, so they go out on their own.
+    """
+    run = []
+    for payload in batch:
+        if payload.startswith(COMPRESSED_FRAME):
+            if run:
+                yield _join(run)
+                run = []
+            yield payload
+        else:
+            run.append(payload)
+    if run:
+        yield _join(run)
+
+def _join(run: List[bytes]) -> bytes:
+    return run[0] if len(run) == 1 else b"[" + b",".join(run) + b"]"
 
 class ConnectionManager:
     def __init__(self):
-        # Maps Character ID to a list of active connections
-        # Example: {"carl_001": [socket1, socket2], "donut_001": [socket3]}
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        # Maps Character ID to the set of active connections
+        # Example: {"carl_001": {socket1, socket2}, "donut_001": {socket3}}
+        self.active_connections: Dict[str, Set[WebSocket]] = defaultdict(set)
+        # Each connection has its own outbound queue, drained by a writer task,
+        # so a slow client never holds up a broadcast
+        self._queues: Dict[WebSocket, asyncio.Queue] = {}
+        self._writers: Dict[WebSocket, asyncio.Task] = {}
+        # Keep pending close() calls referenced so they aren't garbage collected
+        self._closing: Set[asyncio.Task] = set()
 
     async def connect(self, websocket: WebSocket, character_id: str):
         await websocket.accept()
-        if character_id not in self.active_connections:
-            self.active_connections[character_id] = []
-        self.active_connections[character_id].append(websocket)
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self._queues[websocket] = queue
+        self._writers[websocket] = asyncio.create_task(self._writer(websocket, character_id, queue))
+        self.active_connections[character_id].add(websocket)
         print(f"DEBUG: Client connected to {character_id}. Total: {len(self.active_connections[character_id])}")
 
     def disconnect(self, websocket: WebSocket, character_id: str):
-        if character_id in self.active_connections:
-            if websocket in self.active_connections[character_id]:
-                self.active_connections[character_id].remove(websocket)
-            if not self.active_connections[character_id]:
-                del self.active_connections[character_id]
+        connections = self.active_connections.get(character_id)
+        if connections is not None:
+            connections.discard(websocket)
+            if not connections:
+                self.active_connections.pop(character_id, None)
+        self._queues.pop(websocket, None)
+        writer = self._writers.pop(websocket, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
         print(f"DEBUG: Client disconnected from {character_id}.")
 
+    def has_listeners(self, character_id: str) -> bool:
+        return bool(self.active_connections.get(character_id))
+
+    async def send(self, websocket: WebSocket, character_id: str, message: dict):
+        """
+        Send a message to one client, in order with its broadcasts.
+        """
+        self._enqueue(websocket, character_id, _encode(message))
+
     async def broadcast(self, character_id: str, message: dict):
         """
         Send a message to everyone looking at this specific character.
         """
-        if character_id in self.active_connections:
-            for connection in self.active_connections[character_id]:
-                try:
-                    await connection.send_json(message)
-                except Exception as e:
-                    print(f"Error broadcasting: {e}")
-                    # Usually means client closed connection abruptly
-                    pass
\ No newline at end of file
+        await self.broadcast_many(character_id, [message])
+
+    async def broadcast_many(self, character_id: str, messages: List[dict]):
+        """
+        Send several messages, in order, to everyone looking at this character.
+        Each message is encoded once and handed to every client's queue.
+        """
+        # Snapshot, since dropping a slow client mutates the set
+        connections = tuple(self.active_connections.get(character_id, ()))
+        if not connections:
+            return
+
+        payloads = [_encode(message) for message in messages]
+        for connection in connections:
+            for payload in payloads:
+                if not self._enqueue(connection, character_id, payload):
+                    break
+
+    def _enqueue(self, websocket: WebSocket, character_id: str, payload: bytes) -> bool:
+        queue = self._queues.get(websocket)
+        if queue is None:
+            return False
+        try:
+            queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            # Client stopped reading. Drop it rather than buffer without limit.
+            # CharacterCard reconnects with backoff on close and refetches the
+            # whole character once the new socket is open.
+            print(f"DEBUG: Client on {character_id} fell too far behind, dropping.")
+            self.disconnect(websocket, character_id)
+            task = asyncio.create_task(self._close(websocket))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+            return False
+
+    async def _writer(self, websocket: WebSocket, character_id: str, queue: asyncio.Queue):
+        try:
+            while True:
+                batch = [await queue.get()]
+                # Whatever piled up while we were sending goes out together
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+                for frame in _frames(batch):
+                    await websocket.send_bytes(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Usually means client closed connection abruptly
+            print(f"Error broadcasting: {e}")
+            self.disconnect(websocket, character_id)
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            # 1013: try again later
+            await websocket.close(code=1013)
+        except Exception:
+            pass
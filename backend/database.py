@@ -1,93 +1,478 @@
-import boto3
+import aioboto3
+import asyncio
 import os
-from decimal import Decimal
-from typing import Optional, List, Dict, Any
-from botocore.exceptions import ClientError
+import random
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Tuple
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from dotenv import load_dotenv
 
+from character_cache import CharacterCache
+from character_loader import CharacterLoader
+
 load_dotenv()
 
 REGION = os.getenv("AWS_REGION", "us-east-1")
 TABLE_NAME = os.getenv("DYNAMODB_TABLE", "crawler-system-data")
 
-dynamodb = boto3.resource("dynamodb", region_name=REGION)
-table = dynamodb.Table(TABLE_NAME)
+session = aioboto3.Session()
+# Default pool is 10 connections; concurrent requests past that queue for a socket.
+# Short timeouts let adaptive retries move on from a stuck connection quickly.
+BOTO_CONFIG = Config(
+    max_pool_connections=100,
+    retries={'mode': 'adaptive', 'max_attempts': 3},
+    connect_timeout=1.0,
+    read_timeout=3.0,
+    tcp_keepalive=True
+)
+# Low-level client, opened by connect() when the app starts. We marshal
+# attribute values ourselves instead of going through the resource layer.
+client = None
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+# Seconds a read stays cached. Writes from this process invalidate immediately;
+# this only bounds how stale another worker's writes can look.
+CACHE_TTL = float(os.getenv("CHARACTER_CACHE_TTL", "1.0"))
+CACHE_MAXSIZE = 1024
+cache = CharacterCache(ttl=CACHE_TTL, maxsize=CACHE_MAXSIZE)
+
+# Conditional writes (inventory, gold) retry this many times before giving up,
+# sleeping a random slice of a doubling window in between so that writers from
+# other workers spread out instead of colliding again
+WRITE_RETRIES = 5
+WRITE_BACKOFF_BASE = 0.02
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_LIMIT = 100
+# How long coalesced reads wait for company before going out as one batch
+BATCH_WINDOW = float(os.getenv("CHARACTER_BATCH_WINDOW", "0.002"))
+# Backoff (seconds) before re-requesting keys DynamoDB left unprocessed
+BATCH_BACKOFF_BASE = 0.05
+BATCH_BACKOFF_MAX = 1.0
+# Calls per chunk before we stop waiting on a throttled BatchGetItem
+BATCH_MAX_ATTEMPTS = 5
+
+class WriteConflict(Exception):
+    """A conditional write kept losing to concurrent changes; the caller may retry."""
 
 # --- HELPERS ---
-def convert_decimal(obj):
-    if isinstance(obj, list):
-        return [convert_decimal(i) for i in obj]
-    elif isinstance(obj, dict):
-        return {k: convert_decimal(v) for k, v in obj.items()}
-    elif isinstance(obj, Decimal):
-        return int(obj)
-    return obj
+@lru_cache(maxsize=1024)
+def _key(char_id: str) -> Dict[str, Dict[str, str]]:
+    # Already in wire format. Shared between calls - never mutate it.
+    return {'pk': {'S': 'CRAWL#101'}, 'sk': {'S': f"PLAYER#{char_id}"}}
+
+def _serialize(values: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: _serializer.serialize(v) for k, v in values.items()}
+
+def _deserialize(item: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: _deserializer.deserialize(v) for k, v in item.items()}
+
+def _shape_character(item: Dict[str, Any]) -> Dict[str, Any]:
+    # Numbers stay Decimal; serialization.dumps converts them on the way out
+    hp = item.get('hp', {})
+    stats = item.get('stats')
+
+    # Ensure defaults for frontend safety
+    return {
+        "name": item.get('name', 'Unknown'),
+        "race": item.get('race', 'Unknown'),
+        "player_class": item.get('player_class', 'Crawler'),
+        "level": item.get('level', 1),
+        "gold": item.get('gold', 0),
+        "hp": {
+            "current": hp.get('current', 10),
+            "max": hp.get('max', 10),
+            "temp": 0
+        },
+        "stats": stats if stats is not None else {
+            "strength": 10, "dexterity": 10, "constitution": 10,
+            "intelligence": 10, "charisma": 10
+        },
+        "skills": item.get('skills', {}),
+        "feats": item.get('feats', []),
+        "inventory": item.get('inventory', []),
+        "equipment": item.get('equipment', {})
+    }
+
+async def _write_backoff(attempt: int):
+    await asyncio.sleep(random.uniform(0, WRITE_BACKOFF_BASE * 2 ** attempt))
+
+def _is_condition_failure(e: ClientError) -> bool:
+    return e.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+def _failed_inventory(e: ClientError) -> Optional[List[Any]]:
+    """
+    The inventory as it stood when a conditional write failed (raw, only for
+    sizing), or None if the character doesn't exist. Needs the write to ask for
+    ReturnValuesOnConditionCheckFailure="ALL_OLD".
+    """
+    item = e.response.get('Item')
+    if item is None:
+        return None
+    return item.get('inventory', {}).get('L', [])
+
+@asynccontextmanager
+async def connect():
+    """
+    Hold one DynamoDB client (and its connection pool) open for the
+    lifetime of the app. Wired into FastAPI's lifespan in main.py.
+    """
+    global client
+    async with session.client("dynamodb", region_name=REGION, config=BOTO_CONFIG) as dynamodb:
+        client = dynamodb
+        try:
+            # Open a connection (and resolve credentials) before the first request needs one
+            await dynamodb.describe_table(TableName=TABLE_NAME)
+        except (ClientError, BotoCoreError) as e:
+            # Only a warm-up - requests will surface the real error if it persists
+            print(f"DB Error: {e}")
+        try:
+            yield
+        finally:
+            client = None
+
+async def _update(char_id: str, **kwargs) -> Dict[str, Any]:
+    """
+    UpdateItem on a character. Takes the usual UpdateItem arguments with plain
+    Python values and returns whatever ReturnValues asked for, deserialized.
+    """
+    values = kwargs.pop('ExpressionAttributeValues', None)
+    if values is not None:
+        kwargs['ExpressionAttributeValues'] = _serialize(values)
+    response = await client.update_item(TableName=TABLE_NAME, Key=_key(char_id), **kwargs)
+    return _deserialize(response.get('Attributes', {}))
 
 # --- CRUD OPERATIONS ---
 
-def get_character(char_id: str) -> Optional[Dict[str, Any]]:
+async def batch_get_characters(char_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Read many characters with BatchGetItem, 100 keys per call.
+    Returns {char_id: character}; characters that don't exist are left out.
+    """
+    # BatchGetItem rejects duplicate keys
+    char_ids = list(dict.fromkeys(char_ids))
+    found = {}
+    for start in range(0, len(char_ids), BATCH_GET_LIMIT):
+        chunk = char_ids[start:start + BATCH_GET_LIMIT]
+        request = {TABLE_NAME: {'Keys': [_key(c) for c in chunk]}}
+        attempt = 0
+        while request:
+            response = await client.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(TABLE_NAME, []):
+                found[item['sk']['S'].split('#', 1)[1]] = _shape_character(_deserialize(item))
+            # DynamoDB may hand back part of the batch under load
+            request = response.get('UnprocessedKeys')
+            if request:
+                attempt += 1
+                if attempt >= BATCH_MAX_ATTEMPTS:
+                    raise RuntimeError(f"BatchGetItem still throttled after {attempt} attempts")
+                await asyncio.sleep(min(BATCH_BACKOFF_BASE * 2 ** (attempt - 1), BATCH_BACKOFF_MAX))
+    return found
+
+async def get_character_coalesced(char_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Read one character, from the cache when possible. Cache misses arriving
+    within BATCH_WINDOW of each other are fetched together in one BatchGetItem,
+    and concurrent misses on the same character share one read.
+    """
+    cached = cache.get(char_id)
+    if cached is not None:
+        return cached
+
+    version = cache.version(char_id)
     try:
-        response = table.get_item(Key={'pk': 'CRAWL#101', 'sk': f"PLAYER#{char_id}"})
-        if 'Item' not in response:
-            return None
-        
-        item = convert_decimal(response['Item'])
-        
-        # Ensure defaults for frontend safety
-        return {
-            "name": item.get('name', 'Unknown'),
-            "race": item.get('race', 'Unknown'),
-            "player_class": item.get('player_class', 'Crawler'),
-            "level": item.get('level', 1),
-            "gold": int(item.get('gold', 0)),
-            "hp": {
-                "current": item.get('hp', {}).get('current', 10),
-                "max": item.get('hp', {}).get('max', 10),
-                "temp": 0
-            },
-            "stats": item.get('stats', {
-                "strength": 10, "dexterity": 10, "constitution": 10,
-                "intelligence": 10, "charisma": 10
-            }),
-            "skills": item.get('skills', {}),
-            "feats": item.get('feats', []),
-            "inventory": item.get('inventory', []),
-            "equipment": item.get('equipment', {})
-        }
+        data = await loader.load(char_id)
+    except ClientError as e:
+        print(f"DB Error: {e}")
+        return None
+    if data is not None:
+        cache.set(char_id, data, version)
+    return data
+
+async def get_characters(char_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Read several characters at once. Cache misses all go through the loader,
+    so they share BatchGetItem calls. Characters that don't exist are left out.
+    """
+    results = await asyncio.gather(*(get_character_coalesced(c) for c in char_ids))
+    return {c: data for c, data in zip(char_ids, results) if data is not None}
+
+async def _get_attribute(char_id: str, name: str, default: Any) -> Any:
+    """
+    Fetch a single top-level attribute instead of the whole item. Served from
+    the cached character when there is one. Returns None if the character doesn't exist.
+    """
+    cached = cache.get(char_id)
+    if cached is not None:
+        return cached[name]
+
+    try:
+        response = await client.get_item(
+            TableName=TABLE_NAME,
+            Key=_key(char_id),
+            ProjectionExpression="#a",
+            ExpressionAttributeNames={'#a': name}
+        )
     except ClientError as e:
         print(f"DB Error: {e}")
         return None
+    if 'Item' not in response:
+        return None
+    value = response['Item'].get(name)
+    return default if value is None else _deserializer.deserialize(value)
+
+async def get_skills(char_id: str) -> Optional[Dict[str, int]]:
+    return await _get_attribute(char_id, 'skills', {})
+
+async def get_inventory(char_id: str) -> Optional[List[Dict[str, Any]]]:
+    return await _get_attribute(char_id, 'inventory', [])
+
+async def add_inventory_item(char_id: str, item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Grant an item, stacking it onto an existing entry with the same name and type.
+    Each write is conditional on the slot we matched still holding that item, so a
+    concurrent grant makes us re-read and retry instead of overwriting its change.
+    Returns what changed as {path: new value}, or None if the character doesn't exist.
+    Raises WriteConflict if every retry lost to a concurrent change.
+    """
+    for attempt in range(WRITE_RETRIES):
+        inventory = await get_inventory(char_id)
+        if inventory is None:
+            return None
+
+        index = next(
+            (i for i, inv_item in enumerate(inventory)
+             if inv_item['name'] == item['name'] and inv_item.get('type') == item['type']),
+            None
+        )
+        try:
+            if index is not None:
+                # Stack onto the existing slot
+                attributes = await _update(
+                    char_id,
+                    UpdateExpression=f"SET inventory[{index}].#c = if_not_exists(inventory[{index}].#c, :one) + :n",
+                    ConditionExpression=f"inventory[{index}].#n = :name AND inventory[{index}].#t = :type",
+                    ExpressionAttributeNames={'#c': 'count', '#n': 'name', '#t': 'type'},
+                    ExpressionAttributeValues={
+                        ':one': 1, ':n': item['count'], ':name': item['name'], ':type': item['type']
+                    },
+                    ReturnValues="UPDATED_NEW"
+                )
+                cache.invalidate(char_id)
+                # UPDATED_NEW projects just the touched element: {'inventory': [{'count': n}]}
+                count = attributes['inventory'][0]['count']
+                return {f"/inventory/{index}/count": count}
+            else:
+                # New slot - only append if nobody else grew the list since we read it
+                attributes = await _update(
+                    char_id,
+                    UpdateExpression="SET inventory = list_append(if_not_exists(inventory, :empty), :new)",
+                    ConditionExpression="attribute_exists(pk) AND (attribute_not_exists(inventory) OR size(inventory) = :len)",
+                    ExpressionAttributeValues={':empty': [], ':new': [item], ':len': len(inventory)},
+                    ReturnValues="UPDATED_NEW"
+                )
+                cache.invalidate(char_id)
+                return {"/inventory": attributes['inventory']}
+        except ClientError as e:
+            if not _is_condition_failure(e):
+                raise
+            # Our view of the inventory was stale - drop it and re-read
+            cache.invalidate(char_id)
+        await _write_backoff(attempt)
+    raise WriteConflict(f"Inventory of {char_id} kept changing")
+
+async def use_inventory_item(char_id: str, index: int) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    Consume one of the item at `index`: decrement the stack, or drop the slot when
+    it's the last one. Returns (item name, {path: new value}), or None if the
+    character doesn't exist. Raises IndexError if there is no item at that index,
+    or WriteConflict if every retry lost to a concurrent change.
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            attributes = await _update(
+                char_id,
+                UpdateExpression=f"SET inventory[{index}].#c = inventory[{index}].#c - :one",
+                ConditionExpression=f"inventory[{index}].#c > :one",
+                ExpressionAttributeNames={'#c': 'count'},
+                ExpressionAttributeValues={':one': 1},
+                ReturnValues="ALL_NEW",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD"
+            )
+            cache.invalidate(char_id)
+            used = attributes['inventory'][index]
+            return used['name'], {f"/inventory/{index}/count": used['count']}
+        except ClientError as e:
+            if not _is_condition_failure(e):
+                raise
+            inventory = _failed_inventory(e)
+            if inventory is None:
+                return None
+            if index >= len(inventory):
+                raise IndexError(index)
+
+        # Last one in the stack - remove the slot. ALL_OLD tells us what we removed.
+        try:
+            attributes = await _update(
+                char_id,
+                UpdateExpression=f"REMOVE inventory[{index}]",
+                ConditionExpression=(
+                    f"attribute_exists(inventory[{index}]) AND "
+                    f"(attribute_not_exists(inventory[{index}].#c) OR inventory[{index}].#c <= :one)"
+                ),
+                ExpressionAttributeNames={'#c': 'count'},
+                ExpressionAttributeValues={':one': 1},
+                ReturnValues="ALL_OLD",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD"
+            )
+            cache.invalidate(char_id)
+            used = attributes['inventory'].pop(index)
+            return used['name'], {"/inventory": attributes['inventory']}
+        except ClientError as e:
+            if not _is_condition_failure(e):
+                raise
+            inventory = _failed_inventory(e)
+            if inventory is None:
+                return None
+            if index >= len(inventory):
+                raise IndexError(index)
+        # The slot is there but its count went back up under us - go again
+        await _write_backoff(attempt)
+    raise WriteConflict(f"Inventory of {char_id} kept changing")
+
+async def update_gold(char_id: str, amount: int) -> Optional[Dict[str, Any]]:
+    """
+    Atomically add `amount` to gold. Spending more than the character has
+    empties the purse instead of going negative. Returns {path: new value},
+    or None if the character doesn't exist. Raises WriteConflict if every retry
+    lost to a concurrent change.
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            if amount >= 0:
+                attributes = await _update(
+                    char_id,
+                    UpdateExpression="ADD gold :val",
+                    ConditionExpression="attribute_exists(pk)",
+                    ExpressionAttributeValues={':val': amount},
+                    ReturnValues="UPDATED_NEW"
+                )
+            else:
+                # Conditions can't do arithmetic, but they can compare against the cost
+                attributes = await _update(
+                    char_id,
+                    UpdateExpression="ADD gold :val",
+                    ConditionExpression="gold >= :cost",
+                    ExpressionAttributeValues={':val': amount, ':cost': -amount},
+                    ReturnValues="UPDATED_NEW",
+                    ReturnValuesOnConditionCheckFailure="ALL_OLD"
+                )
+            cache.invalidate(char_id)
+            return {"/gold": attributes['gold']}
+        except ClientError as e:
+            if not _is_condition_failure(e):
+                raise
+            # Nothing came back, so there's no such character
+            if 'Item' not in e.response:
+                return None
+
+        # Can't afford it - empty the purse, unless a concurrent grant just covered it
+        try:
+            await _update(
+                char_id,
+                UpdateExpression="SET gold = :zero",
+                ConditionExpression="attribute_exists(pk) AND (attribute_not_exists(gold) OR gold < :cost)",
+                ExpressionAttributeValues={':zero': 0, ':cost': -amount},
+                ReturnValuesOnConditionCheckFailure="ALL_OLD"
+            )
+            cache.invalidate(char_id)
+            return {"/gold": 0}
+        except ClientError as e:
+            if not _is_condition_failure(e):
+                raise
+            if 'Item' not in e.response:
+                return None
+        await _write_backoff(attempt)
+    raise WriteConflict(f"Gold of {char_id} kept changing")
+
+async def update_hp(char_id: str, amount: int) -> Optional[Dict[str, Any]]:
+    """
+    Atomically add `amount` to current HP, clamped to [0, max].
+    In-range changes are a single write. Overshooting takes a second write,
+    conditional on HP still being out of range. Returns {path: new value}, or
+    None if the character doesn't exist.
+    """
+    # Atomic update for nested map. The condition also keeps a missing
+    # character from surfacing as a ValidationException on the SET.
+    try:
+        item = await _update(
+            char_id,
+            UpdateExpression="SET #h.#c = #h.#c + :val",
+            ConditionExpression="attribute_exists(#h.#c)",
+            ExpressionAttributeNames={'#h': 'hp', '#c': 'current'},
+            ExpressionAttributeValues={':val': amount},
+            ReturnValues="ALL_NEW"
+        )
+    except ClientError as e:
+        if not _is_condition_failure(e):
+            raise
+        return None
+    cache.invalidate(char_id)
+
+    # Condition expressions can't do arithmetic, so we can't reject an overshoot
+    # up front - instead pull it back to the bound in place
+    hp = item['hp']
+    clamp = None
+    if 'max' in hp and hp['current'] > hp['max']:
+        clamp = dict(
+            UpdateExpression="SET #h.#c = #h.#m",
+            ConditionExpression="#h.#c > #h.#m",
+            ExpressionAttributeNames={'#h': 'hp', '#c': 'current', '#m': 'max'}
+        )
+    elif hp['current'] < 0:
+        clamp = dict(
+            UpdateExpression="SET #h.#c = :zero",
+            ConditionExpression="#h.#c < :zero",
+            ExpressionAttributeNames={'#h': 'hp', '#c': 'current'},
+            ExpressionAttributeValues={':zero': 0}
+        )
+    if clamp:
+        try:
+            item = await _update(char_id, ReturnValues="ALL_NEW", **clamp)
+            cache.invalidate(char_id)
+        except ClientError as e:
+            if not _is_condition_failure(e):
+                raise
+            # A concurrent change already brought it back in range
+            hp = await _get_attribute(char_id, 'hp', None)
+            if hp is None:
+                return None
+            return {"/hp/current": hp['current']}
+
+    return {"/hp/current": item['hp']['current']}
+
+async def level_up_character(char_id: str) -> Optional[Dict[str, Any]]:
+    """Add one level. Returns {path: new value}, or None if the character doesn't exist."""
+    try:
+        attributes = await _update(
+            char_id,
+            UpdateExpression="SET #l = #l + :val",
+            ConditionExpression="attribute_exists(#l)",
+            ExpressionAttributeNames={'#l': 'level'},
+            ExpressionAttributeValues={':val': 1},
+            ReturnValues="UPDATED_NEW"
+        )
+    except ClientError as e:
+        if not _is_condition_failure(e):
+            raise
+        return None
+    cache.invalidate(char_id)
+    return {"/level": attributes['level']}
+
+# --- READ COALESCING ---
 
-def update_inventory(char_id: str, inventory: List[Dict]):
-    table.update_item(
-        Key={'pk': 'CRAWL#101', 'sk': f"PLAYER#{char_id}"},
-        UpdateExpression="SET inventory = :inv",
-        ExpressionAttributeValues={':inv': inventory}
-    )
-
-def update_gold(char_id: str, amount: int):
-    # Atomic update
-    response = table.update_item(
-        Key={'pk': 'CRAWL#101', 'sk': f"PLAYER#{char_id}"},
-        UpdateExpression="SET gold = if_not_exists(gold, :zero) + :val",
-        ExpressionAttributeValues={':val': amount, ':zero': 0},
-        ReturnValues="UPDATED_NEW"
-    )
-    return convert_decimal(response.get('Attributes', {}))
-
-def update_hp(char_id: str, amount: int):
-    # Atomic update for nested map
-    table.update_item(
-        Key={'pk': 'CRAWL#101', 'sk': f"PLAYER#{char_id}"},
-        UpdateExpression="SET #h.#c = #h.#c + :val",
-        ExpressionAttributeNames={'#h': 'hp', '#c': 'current'},
-        ExpressionAttributeValues={':val': amount}
-    )
-
-def level_up_character(char_id: str):
-    table.update_item(
-        Key={'pk': 'CRAWL#101', 'sk': f"PLAYER#{char_id}"},
-        UpdateExpression="SET #l = #l + :val",
-        ExpressionAttributeNames={'#l': 'level'},
-        ExpressionAttributeValues={':val': 1}
-    )
\ No newline at end of file
+loader = CharacterLoader(batch_get_characters, window=BATCH_WINDOW, max_batch=BATCH_GET_LIMIT)
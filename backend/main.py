@@ -1,18 +1,51 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from pydantic import BaseModel
+from typing import Optional, Dict, Any
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import random
-import json
 
 # --- MODULE IMPORTS ---
 from connection_manager import ConnectionManager
+from character_locker import CharacterLocker
+from serialization import ORJSONResponse
 from models import Item
 import database as db
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with db.connect():
+        yield
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 manager = ConnectionManager()
+locker = CharacterLocker()
+
+# A quiet socket gets pinged after this many seconds, and dropped once
+# this many pings in a row go unanswered
+WS_IDLE_TIMEOUT = 30
+WS_MAX_MISSED_PINGS = 2
+
+# Dedicated generator for dice; bound method skips randint's extra call layer
+_rng_randrange = random.Random().randrange
+
+# --- HELPERS ---
+
+def event(log: Optional[str] = None, changes: Optional[Dict[str, Any]] = None,
+          roll: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Everything one action produced, packed into a single WebSocket frame.
+    `changes` ({"/hp/current": 7}, keyed by JSON Pointer) goes out as JSON
+    Patch replace ops rather than the whole character. The frontend applies
+    whichever keys are set.
+    """
+    patch = [{"op": "replace", "path": path, "value": value}
+             for path, value in changes.items()] if changes else None
+    return {"type": "event", "log": log, "patch": patch, "roll": roll}
 
 # --- API ENDPOINTS ---
 
@@ -21,22 +54,31 @@ class RollRequest(BaseModel):
 
 @app.get("/character/{char_id}")
 async def get_character(char_id: str):
-    data = db.get_character(char_id)
+    data = await db.get_character_coalesced(char_id)
     if not data:
         raise HTTPException(status_code=404, detail="Character not found")
-    return data
+    # Returned as a response so FastAPI doesn't walk it with jsonable_encoder first
+    return ORJSONResponse(data)
+
+@app.get("/characters")
+async def get_characters(ids: str):
+    """Several characters in one call, e.g. /characters?ids=carl_001,donut_001"""
+    char_ids = list(dict.fromkeys(c for c in ids.split(",") if c))
+    if len(char_ids) > db.BATCH_GET_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {db.BATCH_GET_LIMIT} ids per request")
+    return ORJSONResponse(await db.get_characters(char_ids))
 
 @app.post("/character/{char_id}/roll")
 async def roll_skill(char_id: str, request: RollRequest):
-    char_data = db.get_character(char_id)
-    if not char_data:
+    skills = await db.get_skills(char_id)
+    if skills is None:
         raise HTTPException(status_code=404)
 
     skill_name = request.skill_name.lower()
-    modifier = char_data['skills'].get(skill_name, 0)
+    modifier = skills.get(skill_name, 0)
     
     # THE ROLL
-    d20 = random.randint(1, 20)
+    d20 = _rng_randrange(1, 21)
     total = d20 + modifier
     
     crit_msg = ""
@@ -45,140 +87,162 @@ async def roll_skill(char_id: str, request: RollRequest):
 
     log_msg = f"Rolled {request.skill_name.title()}: {d20} + {modifier} = {total}{crit_msg}"
     
-    await manager.broadcast(char_id, {"type": "log", "message": log_msg})
-    await manager.broadcast(char_id, {
-        "type": "roll_result", 
-        "payload": {
+    if manager.has_listeners(char_id):
+        await manager.broadcast(char_id, event(log=log_msg, roll={
             "skill": request.skill_name,
             "d20": d20,
             "mod": modifier,
             "total": total,
             "crit": d20 == 20 or d20 == 1
-        }
-    })
+        }))
     
     return {"status": "success", "total": total}
 
 @app.post("/character/{char_id}/add-item")
 async def add_item(char_id: str, item: Item):
-    char_data = db.get_character(char_id)
-    if not char_data:
+    new_item = item.model_dump()
+
+    # Stacking happens atomically in the DB
+    async with locker.lock(char_id):
+        try:
+            changes = await db.add_inventory_item(char_id, new_item)
+        except db.WriteConflict:
+            raise HTTPException(status_code=409, detail="Inventory changed, retry")
+    if not changes:
         raise HTTPException(status_code=404)
-        
-    inventory = char_data['inventory']
-    
-    # Stack Logic
-    found = False
-    for inv_item in inventory:
-        if inv_item['name'] == item.name and inv_item.get('type') == item.type:
-            inv_item['count'] = inv_item.get('count', 1) + item.count
-            found = True
-            break
-            
-    if not found:
-        # Pydantic .dict() or .model_dump() (v2)
-        new_item = item.dict() if hasattr(item, 'dict') else item.model_dump()
-        inventory.append(new_item)
-        
-    db.update_inventory(char_id, inventory)
     
     # Broadcast
-    updated_char = db.get_character(char_id)
-    await manager.broadcast(char_id, {"type": "update", "payload": updated_char})
-    await manager.broadcast(char_id, {"type": "log", "message": f"SYSTEM GRANTED: {item.name} (x{item.count})"})
+    if manager.has_listeners(char_id):
+        log_msg = f"SYSTEM GRANTED: {item.name} (x{item.count})"
+        await manager.broadcast(char_id, event(log=log_msg, changes=changes))
     
     return {"status": "success"}
 
 @app.post("/character/{char_id}/use-item")
 async def use_item(char_id: str, item_index: int):
-    char_data = db.get_character(char_id)
-    if not char_data:
-        raise HTTPException(status_code=404)
-        
-    inventory = char_data['inventory']
-    if item_index < 0 or item_index >= len(inventory):
+    if item_index < 0:
         raise HTTPException(status_code=400, detail="Invalid item index")
-        
-    item = inventory[item_index]
-    item_name = item['name']
-    
-    current_count = item.get('count', 1)
-    if current_count > 1:
-        inventory[item_index]['count'] = current_count - 1
-    else:
-        inventory.pop(item_index)
-        
-    db.update_inventory(char_id, inventory)
+
+    async with locker.lock(char_id):
+        try:
+            result = await db.use_inventory_item(char_id, item_index)
+        except IndexError:
+            raise HTTPException(status_code=400, detail="Invalid item index")
+        except db.WriteConflict:
+            raise HTTPException(status_code=409, detail="Inventory changed, retry")
+    if not result:
+        raise HTTPException(status_code=404, detail="Character not found")
+    item_name, changes = result
     
-    updated_char = db.get_character(char_id)
-    await manager.broadcast(char_id, {"type": "update", "payload": updated_char})
-    await manager.broadcast(char_id, {"type": "log", "message": f"Used {item_name}."})
+    if manager.has_listeners(char_id):
+        await manager.broadcast(char_id, event(log=f"Used {item_name}.", changes=changes))
     
     return {"status": "success"}
 
 @app.post("/character/{char_id}/adjust-hp")
 async def adjust_hp(char_id: str, amount: int):
     try:
-        db.update_hp(char_id, amount)
-        
-        updated_char = db.get_character(char_id)
-        await manager.broadcast(char_id, {"type": "update", "payload": updated_char})
-        
-        action = "Healed" if amount > 0 else "Took Damage"
-        log_msg = f"{action} ({abs(amount)}). HP is now {updated_char['hp']['current']}."
-        await manager.broadcast(char_id, {"type": "log", "message": log_msg})
-        
-        return {"status": "success"}
+        changes = await db.update_hp(char_id, amount)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not changes:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+    if manager.has_listeners(char_id):
+        action = "Healed" if amount > 0 else "Took Damage"
+        log_msg = f"{action} ({abs(amount)}). HP is now {changes['/hp/current']}."
+        await manager.broadcast(char_id, event(log=log_msg, changes=changes))
+
+    return {"status": "success"}
 
 @app.post("/character/{char_id}/adjust-gold")
 async def adjust_gold(char_id: str, amount: int):
     try:
-        db.update_gold(char_id, amount)
-        updated_char = db.get_character(char_id)
-        
-        await manager.broadcast(char_id, {"type": "update", "payload": updated_char})
-        
-        action = "Received" if amount > 0 else "Paid"
-        log_msg = f"FINANCE: {action} {abs(amount)} Gold."
-        await manager.broadcast(char_id, {"type": "log", "message": log_msg})
-        
-        return {"status": "success"}
+        changes = await db.update_gold(char_id, amount)
+    except db.WriteConflict:
+        raise HTTPException(status_code=409, detail="Gold changed, retry")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not changes:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+    if manager.has_listeners(char_id):
+        action = "Received" if amount > 0 else "Paid"
+        log_msg = f"FINANCE: {action} {abs(amount)} Gold."
+        await manager.broadcast(char_id, event(log=log_msg, changes=changes))
+
+    return {"status": "success"}
 
 @app.post("/character/{char_id}/level-up")
 async def level_up(char_id: str):
     try:
-        db.level_up_character(char_id)
-        updated_char = db.get_character(char_id)
-        
-        await manager.broadcast(char_id, {"type": "update", "payload": updated_char})
-        await manager.broadcast(char_id, {"type": "log", "message": f"LEVEL UP! You are now Level {updated_char['level']}!"})
-        
-        return {"status": "success"}
+        changes = await db.level_up_character(char_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not changes:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+    if manager.has_listeners(char_id):
+        log_msg = f"LEVEL UP! You are now Level {changes['/level']}!"
+        await manager.broadcast(char_id, event(log=log_msg, changes=changes))
+
+    return {"status": "success"}
 
 @app.websocket("/ws/{char_id}")
 async def websocket_endpoint(websocket: WebSocket, char_id: str):
     await manager.connect(websocket, char_id)
+    missed_pings = 0
     try:
         while True:
-            await websocket.receive_text()
+            try:
+                await asyncio.wait_for(websocket.receive_text(), timeout=WS_IDLE_TIMEOUT)
+                missed_pings = 0
+            except asyncio.TimeoutError:
+                if missed_pings >= WS_MAX_MISSED_PINGS:
+                    # Half-open connection (killed tab, NAT drop) - stop broadcasting to it
+                    await websocket.close()
+                    break
+                missed_pings += 1
+                await manager.send(websocket, char_id, {"type": "ping"})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket, char_id)
 
 # --- DEPLOYMENT ---
+class SPAStaticFiles(StaticFiles):
+    """
+    Serves the built frontend. Paths that aren't files fall back to index.html
+    so client-side routes still work on a hard refresh or deep link.
+    """
+    def __init__(self, directory: str, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        # Every navigation lands on index.html - keep it in memory instead of
+        # stat-ing and re-opening the file each time
+        with open(os.path.join(directory, "index.html"), "rb") as f:
+            self.index_html = f.read()
+
+    def index_response(self) -> Response:
+        return Response(
+            content=self.index_html,
+            media_type="text/html",
+            headers={"Cache-Control": "public, max-age=60"}
+        )
+
+    async def get_response(self, path: str, scope):
+        # Other verbs fall through so StaticFiles answers them with a 405
+        if path in (".", "index.html") and scope["method"] in ("GET", "HEAD"):
+            return self.index_response()
+        try:
+            return await super().get_response(path, scope)
+        except StarletteHTTPException as e:
+            # Missing API/WS paths and build assets are real 404s
+            if e.status_code != 404 or path.startswith(("api", "ws", "assets")):
+                raise
+            return self.index_response()
+
 frontend_path = os.path.join(os.path.dirname(__file__), "../frontend/dist")
 if os.path.exists(frontend_path):
-    app.mount("/assets", StaticFiles(directory=os.path.join(frontend_path, "assets")), name="assets")
-    @app.get("/")
-    async def serve_root():
-        return FileResponse(os.path.join(frontend_path, "index.html"))
-    @app.get("/{full_path:path}")
-    async def serve_spa(full_path: str):
-        if full_path.startswith("api") or full_path.startswith("ws"):
-            raise HTTPException(status_code=404)
-        return FileResponse(os.path.join(frontend_path, "index.html"))
\ No newline at end of file
+    # Mounted last so every API/WS route above takes precedence.
+    # In production a reverse proxy / CDN should serve these files instead.
+    app.mount("/", SPAStaticFiles(directory=frontend_path, html=True), name="frontend")
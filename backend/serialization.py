@@ -0,0 +1,19 @@
+import orjson
+from decimal import Decimal
+from fastapi.responses import JSONResponse
+from typing import Any
+
+def _default(obj: Any) -> Any:
+    # DynamoDB hands every number back as a Decimal; convert them as we encode
+    # instead of rebuilding each item beforehand
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    return str(obj)
+
+def dumps(obj: Any) -> bytes:
+    """Shared encoder for HTTP responses and WebSocket frames."""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS, default=_default)
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)